@@ -1,12 +1,9 @@
 from copy import deepcopy
 from itertools import product
-import time, sys
+import time, sys, os
 import numpy as np
 import h5py
-#try:
-#    from sklearn.neighbors import KDTree
-#except(ImportError):
-from scipy.spatial import cKDTree as KDTree
+from numba import njit
 
 from numpy.lib import recfunctions
 import minesweeper
@@ -22,6 +19,84 @@ MISTrename = {
     'log(g)':'log_g',
 }
 
+@njit(cache=True)
+def _params_to_grid(targ, grid_flat, binwidths_flat, grid_offsets):
+    """Compiled kernel for GenMIST.params_to_grid. Returns the fractional 
+    pixel coordinates and a flag that is False if any parameter falls 
+    outside of the grid.
+    """
+    ndim = targ.shape[0]
+    xtarg = np.empty(ndim)
+    for d in range(ndim):
+        lo = grid_offsets[d]
+        n = grid_offsets[d+1] - lo
+        i = np.searchsorted(grid_flat[lo:lo+n], targ[d], side='right') - 1
+        if (i < 0) or (i >= n-1):
+            return xtarg, False
+        # each dimension has one less binwidth than gridpoints
+        xtarg[d] = i + (targ[d] - grid_flat[lo+i]) / binwidths_flat[lo-d+i]
+    return xtarg, True
+
+@njit(cache=True)
+def _knearest_inds(xtarg, strides, offset_keys, vertex_keys, vertex_inds):
+    """Compiled kernel for GenMIST.knearest_inds. Looks up the packed key of 
+    each corner of the grid cell containing xtarg in the sorted vertex keys.
+    """
+    basekey = 0
+    for d in range(xtarg.shape[0]):
+        basekey += np.int64(np.floor(xtarg[d])) * strides[d]
+    nvert = vertex_keys.shape[0]
+    inds = np.empty(offset_keys.shape[0], dtype=np.int64)
+    nfound = 0
+    for k in range(offset_keys.shape[0]):
+        key = basekey + offset_keys[k]
+        pos = np.searchsorted(vertex_keys, key)
+        if (pos < nvert) and (vertex_keys[pos] == key):
+            inds[nfound] = vertex_inds[pos]
+            nfound += 1
+    return np.sort(inds[:nfound])
+
+@njit(cache=True)
+def _linear_weights(X, knearest, xtarg):
+    """Compiled kernel for GenMIST.linear_weights.
+    """
+    nk = knearest.shape[0]
+    ndim = xtarg.shape[0]
+    wght = np.empty(nk)
+    for k in range(nk):
+        w = 1.0
+        for d in range(ndim):
+            dx = xtarg[d] - X[knearest[k],d]
+            if (dx <= -1.0) or (dx >= 1.0):
+                w = 0.0
+                break
+            w *= 1.0 - abs(dx)
+        wght[k] = w
+    return wght
+
+@njit(cache=True)
+def _weights(targ, grid_flat, binwidths_flat, grid_offsets, X, strides,
+             offset_keys, vertex_keys, vertex_inds, strictness):
+    """Compiled kernel for GenMIST.weights, running the params_to_grid, 
+    knearest_inds and linear_weights kernels in a single call.  Returns the 
+    vertex indices, their weights, and a status flag (0 = good, 1 = outside 
+    of grid, 2 = no vertices, 3 = bad weights).
+    """
+    xtarg, ingrid = _params_to_grid(targ, grid_flat, binwidths_flat, grid_offsets)
+    if not ingrid:
+        return np.empty(0, dtype=np.int64), np.empty(0), 1
+    inds = _knearest_inds(xtarg, strides, offset_keys, vertex_keys, vertex_inds)
+    if inds.shape[0] == 0:
+        return inds, np.empty(0), 2
+    wght = _linear_weights(X, inds, xtarg)
+    if wght.sum() <= strictness:
+        return inds, wght, 3
+    good = wght > 0
+    inds = inds[good]
+    wght = wght[good]
+    wght /= wght.sum()
+    return inds, wght, 0
+
 class GenMIST(object):
 
 
@@ -41,6 +116,16 @@ class GenMIST(object):
 
         # turn on age weighting
         self.ageweight = kwargs.get('ageweight',True)
+
+        # use the precomputed pixel grid stored in the model file if present
+        self.usepixelgrid = kwargs.get('usepixelgrid',True)
+
+        # optionally keep the model outputs in a .npy file that is memory 
+        # mapped read-only, so only the rows that are used get paged in and 
+        # the pages are shared between processes
+        self.outputmmap = kwargs.get('outputmmap',None)
+        if (self.outputmmap is not None) and (not self.outputmmap.endswith('.npy')):
+            self.outputmmap = self.outputmmap + '.npy'
         
         self.labels = kwargs.get('labels',['EEP','initial_Mass','initial_[Fe/H]','initial_[a/Fe]'])
         # list of output parametrs you want from MIST 
@@ -64,14 +149,10 @@ class GenMIST(object):
 
         with h5py.File(self.mistfile, "r") as misth5:
             self.make_lib(misth5)
-        self.lib_as_grid()
-
-        searchrad = 1.0
-        self.dist = np.sqrt( 
-            (searchrad**2.0) + 
-            (searchrad**2.0) + 
-            (searchrad**2.0) + 
-            (searchrad**2.0))
+            if self.usepixelgrid:
+                self.lib_as_grid(misth5.get('pixelgrid',None))
+            else:
+                self.lib_as_grid()
 
     def make_lib(self, misth5):
         """Convert the HDF5 input to ndarrays for labels and outputs.
@@ -81,48 +162,197 @@ class GenMIST(object):
         self.libparams = np.concatenate([np.array(misth5[z])[cols] for z in misth5["index"]])
         self.libparams.dtype.names = tuple(self.labels)
 
-        cols = [MISTrename[x] if x in MISTrename.keys() else x for x in self.predictions]
-        self.output = [np.concatenate([misth5[z][p] for z in misth5["index"]])
-                       for p in cols]
-        self.output = np.array(self.output)
-
         self.libparams['initial_Mass']   = np.around(self.libparams['initial_Mass'],decimals=2)
         self.libparams['initial_[Fe/H]'] = np.around(self.libparams['initial_[Fe/H]'],decimals=2)
         self.libparams['initial_[a/Fe]'] = np.around(self.libparams['initial_[a/Fe]'],decimals=2)
 
-        # if self.ageweight:
-        #     if self.verbose:
-        #         print('... Fitting w/ equal Age weighting')
-        #     self.addagewgt()
+        if (self.outputmmap is not None) and self.read_outputmmap():
+            return
+
+        cols = [MISTrename[x] if x in MISTrename.keys() else x for x in self.predictions]
+        # older track files do not carry a precomputed Agewgt column,
+        # in that case compute it from the tracks themselves
+        calcagewgt = (
+            self.ageweight and 
+            ('Agewgt' not in misth5[misth5["index"][0]].dtype.names))
+        if calcagewgt:
+            cols.remove('Agewgt')
+        # fill a C-contiguous (Nlib, Npred) array column by column so the 
+        # rows gathered for each interpolation are contiguous in memory
+        self.output = np.empty((len(self.libparams),len(self.predictions)))
+        for ii,p in enumerate(cols):
+            self.output[:,ii] = np.concatenate([misth5[z][p] for z in misth5["index"]])
+
+        if calcagewgt:
+            if self.verbose:
+                print('... Calculating Age Weighting')
+            self.addagewgt()
+
+        if self.outputmmap is not None:
+            # write the outputs to disk (one named field per prediction, 
+            # with the MIST file they came from as the title of the first) 
+            # and map them back in, via a temporary file so that other 
+            # processes never see a partially written file
+            fields = [(p, self.output.dtype) for p in self.predictions]
+            fields[0] = ((self.mistsource(), fields[0][0]), fields[0][1])
+            tmpfile = '{0}.{1}.tmp'.format(self.outputmmap, os.getpid())
+            try:
+                with open(tmpfile, 'wb') as f:
+                    np.save(f, self.output.view(fields).ravel())
+                os.replace(tmpfile, self.outputmmap)
+            except:
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+                raise
+            self.read_outputmmap()
+
+    def mistsource(self):
+        """Identify the MIST file by its absolute path, size and mtime.
+        """
+        st = os.stat(self.mistfile)
+        return '{0}|{1}|{2}'.format(
+            os.path.abspath(self.mistfile), st.st_size, st.st_mtime_ns)
+
+    def read_outputmmap(self):
+        """Memory map the model outputs from ``outputmmap``.
 
-        self.output = self.output.T
+        :returns success:
+            False if the file is missing, or was written from a different 
+            MIST file or for a different set of predictions or library.
+        """
+        if not os.path.isfile(self.outputmmap):
+            return False
+        output = np.load(self.outputmmap, mmap_mode='r')
+        if ((output.dtype.names != tuple(self.predictions)) or 
+            (len(output) != len(self.libparams)) or
+            (output.dtype.fields[output.dtype.names[0]][2:] != (self.mistsource(),))):
+            return False
+        self.output = output.view(output.dtype[0]).reshape(len(output), -1)
+        return True
+
+    def __getstate__(self):
+        # a memory mapped output is mapped again on unpickling (e.g., in 
+        # spawned pool workers) rather than copied along with the object
+        state = self.__dict__.copy()
+        if self.outputmmap is not None:
+            state['output'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if (self.outputmmap is not None) and (not self.read_outputmmap()):
+            raise IOError('Could not map MIST outputs from {}'.format(self.outputmmap))
+
+    def addagewgt(self):
+        """Compute the age weights, d(Age)/d(EEP) normalized along each 
+        mass track, and store them in the last column of the output array.
+
+        The library is sorted once by (FeH, aFe, mass, EEP) so that every 
+        track is a contiguous slice, which lets the gradient and the 
+        per-track normalization be done in a single vectorized pass.
+        """
+        age_ind = self.predictions.index('log(Age)')
+        age_wgtarr = np.zeros(len(self.libparams['EEP']))
+
+        # sort library so each track is contiguous and ordered in EEP
+        order = np.lexsort((
+            self.libparams['EEP'],
+            self.libparams['initial_Mass'],
+            self.libparams['initial_[a/Fe]'],
+            self.libparams['initial_[Fe/H]'],
+            ))
+        keys = np.stack([
+            self.libparams['initial_[Fe/H]'][order],
+            self.libparams['initial_[a/Fe]'][order],
+            self.libparams['initial_Mass'][order],
+            ])
+        newtrk = np.any(keys[:,1:] != keys[:,:-1],axis=0)
+        starts = np.concatenate([[0],np.flatnonzero(newtrk)+1])
+        ends = np.append(starts[1:],len(order))
+        lengths = ends - starts
+
+        aa = 10.0**self.output[:,age_ind].take(order)
+
+        # central differences, with one-sided differences at track ends
+        grad = np.zeros_like(aa)
+        grad[1:-1] = 0.5*(aa[2:]-aa[:-2])
+        multi = lengths > 1
+        grad[starts[multi]] = aa[starts[multi]+1]-aa[starts[multi]]
+        grad[ends[multi]-1] = aa[ends[multi]-1]-aa[ends[multi]-2]
+        # single point tracks get no weight
+        grad[starts[~multi]] = 0.0
+
+        # normalize each track
+        gradsum = np.add.reduceat(grad,starts)
+        gradsum[gradsum == 0.0] = 1.0
+        age_wgtarr[order] = grad/np.repeat(gradsum,lengths)
+
+        # check for zeros and replace with small value to keep from throwing errors
+        cond = age_wgtarr < np.finfo(float).eps
+        age_wgtarr[cond] = np.finfo(float).eps
+
+        self.output[:,-1] = age_wgtarr
 
     def getMIST(self, mass=1.0, eep=300, feh=0.0, afe=0.0, **kwargs):
         """
         """
         try:
             inds, wghts = self.weights(mass=mass, eep=eep, feh=feh, afe=afe)
-            predpars = np.dot(wghts, self.output[inds, :])
+            predpars = np.dot(wghts, self.output.take(inds, axis=0))
             return [eep,mass,feh,afe]+list(predpars)
         except(ValueError):
             return None
 
-    def lib_as_grid(self):
+    def lib_as_grid(self, pixelgrid=None):
         """Convert the library parameters to pixel indices in each dimension,
-        and build and store a KDTree for the pixel coordinates.
+        and build and store a lookup table for the pixel coordinates.
+
+        :param pixelgrid: (optional)
+            HDF5 group written by ``prepare_mistfile`` with the precomputed
+            pixel coordinates and gridpoints.  Used instead of digitizing 
+            the library if it was made for the same labels and library.
         """
-        # Get the unique gridpoints in each param
         self.gridpoints = {}
         self.binwidths = {}
-        for p in self.labels:
-            self.gridpoints[p] = np.unique(self.libparams[p])
-            self.binwidths[p] = np.diff(self.gridpoints[p])
-        # Digitize the library parameters
-        X = np.array([np.digitize(self.libparams[p], bins=self.gridpoints[p],
-                                  right=True) for p in self.labels])
-        self.X = X.T
-        # Build the KDTree
-        self._kdt = KDTree(self.X)  # , metric='euclidean')
+        if ((pixelgrid is not None) and 
+            (list(pixelgrid.attrs['labels']) == list(self.labels)) and
+            (pixelgrid['X'].shape == (len(self.libparams), self.ndim))):
+            # Read the stored gridpoints and pixel coordinates
+            for ii, p in enumerate(self.labels):
+                self.gridpoints[p] = pixelgrid['gridpoints_{}'.format(ii)][()]
+                self.binwidths[p] = np.diff(self.gridpoints[p])
+            X = pixelgrid['X'][()].T
+        else:
+            # Get the unique gridpoints in each param
+            for p in self.labels:
+                self.gridpoints[p] = np.unique(self.libparams[p])
+                self.binwidths[p] = np.diff(self.gridpoints[p])
+            # Digitize the library parameters
+            X = np.array([np.digitize(self.libparams[p], bins=self.gridpoints[p],
+                                      right=True) for p in self.labels])
+        # pixel indices easily fit in int16 for the MIST grids, halving the 
+        # memory touched for each vertex compared to int32
+        if X.max() <= np.iinfo(np.int16).max:
+            self.X = np.ascontiguousarray(X.T, dtype=np.int16)
+        else:
+            self.X = np.ascontiguousarray(X.T, dtype=np.int32)
+        # Flatten gridpoints and binwidths into single contiguous arrays 
+        # with per-label offsets for the compiled params_to_grid kernel
+        self._gridlen = np.array([len(self.gridpoints[p]) for p in self.labels])
+        self._grid_offsets = np.concatenate([[0], np.cumsum(self._gridlen)])
+        self._grid_flat = np.concatenate([self.gridpoints[p] for p in self.labels])
+        self._binwidths_flat = np.concatenate([self.binwidths[p] for p in self.labels])
+        # Pack the pixel coordinates into a single integer key (with room 
+        # for one pixel past the edge in each dimension) and build a sorted 
+        # lookup table of the library vertices
+        self._vertex_strides = np.cumprod(
+            np.concatenate([[1], self._gridlen[:-1]+1])).astype(np.int64)
+        vertex_keys = self.X @ self._vertex_strides
+        self._vertex_inds = np.argsort(vertex_keys, kind='stable')
+        self._vertex_keys = vertex_keys[self._vertex_inds]
+        # key offsets to the 2**ndim corners of a grid cell
+        self._offset_keys = (
+            np.array(list(product([0, 1], repeat=self.ndim))) @ self._vertex_strides)
 
     def params_to_grid(self, **targ):
         """Convert a set of parameters to grid pixel coordinates.
@@ -134,20 +364,16 @@ class GenMIST(object):
         :returns x:
             The target parameter location in pixel coordinates.
         """
-        # Get bin index
-        inds = np.array([np.digitize([targ[p]], bins=self.gridpoints[p], right=False) - 1
-                         for p in self.labels])
-        inds = np.squeeze(inds)
-        # Get fractional index.
-        try:
-            find = [(targ[p] - self.gridpoints[p][i]) / self.binwidths[p][i]
-                    for i, p in zip(inds, self.labels)]
-        except(IndexError):
+        # Get bin index plus fractional index
+        xtarg, ingrid = _params_to_grid(
+            np.array([targ[p] for p in self.labels], dtype=float),
+            self._grid_flat, self._binwidths_flat, self._grid_offsets)
+        if not ingrid:
             pstring = "{0}: min={2} max={3} targ={1}\n"
             s = [pstring.format(p, targ[p], *self.gridpoints[p][[0, -1]])
                  for p in self.labels]
             raise ValueError("At least one parameter outside grid.\n{}".format(' '.join(s)))
-        return inds + np.squeeze(find)
+        return xtarg
 
     def weights(self, **params):
         # translate keys into MIST model names
@@ -156,40 +382,36 @@ class GenMIST(object):
         params['initial_[Fe/H]'] = params.pop('feh')
         params['initial_[a/Fe]'] = params.pop('afe')
 
-        xtarg = self.params_to_grid(**params)
-        inds = self.knearest_inds(xtarg)
-        if len(inds) == 0:
+        # params_to_grid -> knearest_inds -> linear_weights in one call
+        inds, wghts, status = _weights(
+            np.array([params[p] for p in self.labels], dtype=float),
+            self._grid_flat, self._binwidths_flat, self._grid_offsets,
+            self.X, self._vertex_strides, self._offset_keys,
+            self._vertex_keys, self._vertex_inds, self._strictness)
+        if status == 1:
+            # raises the ValueError describing the out of grid parameters
+            self.params_to_grid(**params)
+        if status == 2:
             raise ValueError
-        wghts = self.linear_weights(inds, xtarg)
-        if wghts.sum() <= self._strictness:
+        if status == 3:
             raise ValueError("Something is wrong with the weights, sum == {}".format(wghts.sum()))
-        good = wghts > 0
-        inds = inds[good]
-        wghts = wghts[good]
-        wghts /= wghts.sum()
         return inds, wghts
 
     def knearest_inds(self, xtarg):
-        """Find all parameter ``vertices`` within a sphere of radius
-        sqrt(ndim).  The parameter values are converted to pixel coordinates
-        before a search of the KDTree.
+        """Find all parameter ``vertices`` of the grid cell containing the 
+        target.  The 2**ndim corners of the cell are enumerated directly and 
+        looked up in the vertex table, corners missing from the library are 
+        skipped.
 
         :param xtarg:
              The target location, in units of grid indices.
 
         :returns inds:
-             The sorted indices of all vertices within sqrt(ndim) of the pixel
-             coordinates, corresponding to **params.
+             The sorted indices of all vertices of the grid cell containing 
+             the pixel coordinates, corresponding to **params.
         """
-        # Query the tree within radius sqrt(ndim)
-        #try:
-        #    inds = self._kdt.query_radius(xtarg.reshape(1, -1),
-        #                                  r=np.sqrt(self.ndim))
-        #except(AttributeError):
-        inds = self._kdt.query_ball_point(xtarg.reshape(1, -1),
-                                          # np.sqrt(self.ndim))
-                                          self.dist)
-        return np.sort(inds[0])
+        return _knearest_inds(xtarg, self._vertex_strides, self._offset_keys,
+                              self._vertex_keys, self._vertex_inds)
 
     def linear_weights(self, knearest, xtarg):
         """Use ND-linear interpolation over the knearest neighbors.
@@ -203,11 +425,29 @@ class GenMIST(object):
             formed by the target parameter and each vertex.  Vertices more than
             1 away from the target in any dimension are given a weight of zero.
         """
-        x = self.X[knearest, :]
-        dx = xtarg - x
-        # Fractional pixel weights
-        wght = ((1 - dx) * (dx >= 0) + (1 + dx) * (dx < 0))
-        # set weights to zero if model is more than a pixel away
-        wght *= (dx > -1) * (dx < 1)
-        # compute hyperarea for each model and return
-        return wght.prod(axis=-1)
+        return _linear_weights(self.X, knearest, xtarg)
+
+def prepare_mistfile(mistfile, **kwargs):
+    """Digitize the library of a MIST track file once and store the pixel
+    coordinates and gridpoints in the file (as the ``pixelgrid`` group), 
+    so that GenMIST can read them at start up instead of recomputing them.
+
+    :param mistfile:
+        Path to the MIST HDF5 file, it is opened in append mode.
+
+    :param kwargs:
+        Passed on to GenMIST (e.g., ``labels``).
+    """
+    kwargs['usepixelgrid'] = False
+    kwargs.setdefault('verbose', False)
+    GM = GenMIST(MISTpath=mistfile, **kwargs)
+
+    with h5py.File(mistfile, "r+") as misth5:
+        if 'pixelgrid' in misth5:
+            del misth5['pixelgrid']
+        pixelgrid = misth5.create_group('pixelgrid')
+        # labels contain '/', so datasets are named by label index
+        pixelgrid.attrs['labels'] = GM.labels
+        pixelgrid.create_dataset('X', data=GM.X)
+        for ii, p in enumerate(GM.labels):
+            pixelgrid.create_dataset('gridpoints_{}'.format(ii), data=GM.gridpoints[p])
@@ -1,8 +1,12 @@
 # #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import sys
+import math
+import time
 import numpy as np
 from datetime import datetime 
+from operator import itemgetter
+from multiprocessing import Pool
 
 import dynesty
 
@@ -187,6 +191,9 @@ class FitMS(object):
           if inputdict.get('isochrone_prior',True):
                # get path for MIST models
                self.fitargs['MISTpath'] = inputdict.get('MISTpath',None)
+               # optional .npy file to memory map the MIST outputs from, 
+               # shared between parallel workers
+               self.fitargs['MISToutputmmap'] = inputdict.get('MISToutputmmap',None)
 
                for pp in ['Teff','log(g)','[Fe/H]','[a/Fe]','log(R)','log(A)']:
                     self.fitpars_bool[pp] = False
@@ -230,14 +237,107 @@ class FitMS(object):
                })
 
      def _initoutput(self,parnames):
-          # init output file
-          self.outff = open(self.output,'w')
+          # init output file, with a large buffer as rows are written in blocks
+          self.outff = open(self.output,'w',buffering=1024*1024)
           self.outff.write('Iter ')
           for pp in parnames:
                self.outff.write('{} '.format(pp))
           self.outff.write('log(lk) log(vol) log(wt) h nc log(z) delta(log(z))')
           self.outff.write('\n')
 
+          # precompile the row format and parameter lookup, rows are 
+          # buffered and written out in _flushoutput
+          self._getpars = itemgetter(*parnames)
+          self._row_fmt = '{} ' + ' '.join(['{}']*len(parnames)) + ' {} {} {} {} {} {} {} \n'
+          self._rowbuf = []
+
+     def _writerow(self,it,results):
+          # results = loglstar,logvol,logwt,h,nc,logz,delta_logz
+          pars = self._getpars(self.likeobj.parsdict)
+          self._rowbuf.append(self._row_fmt.format(
+               it,
+               *[pp if isinstance(pp,(float,int)) else 'nan' for pp in pars],
+               *results))
+
+     def _flushoutput(self):
+          self.outff.write(''.join(self._rowbuf))
+          self._rowbuf.clear()
+          self.outff.flush()
+
+     def _printstatus(self,nit,nc,ncall,eff,logz,logzvar,delta_logz,delta_logz_final,
+          itertimes,loglstar=None):
+          # format/output results, loglk is included if loglstar is given
+          if logz < -1e6:
+               logz = -np.inf
+          if delta_logz > 1e8:
+               delta_logz = np.inf
+          if logzvar > 0.:
+               logzerr = np.sqrt(logzvar)
+          else:
+               logzerr = np.nan
+          if logzerr > 1e8:
+               logzerr = np.inf
+
+          if loglstar is None:
+               lkstr = ''
+          else:
+               if loglstar < -1e6:
+                    loglstar = -np.inf
+               lkstr = 'loglk: {0:6.3f} | '.format(loglstar)
+          try:
+               sys.stdout.write("\riter: {0:d} | nc: {1:d} | ncall: {2:d} | eff(%): {3:6.3f} | "
+                    "logz: {4:6.3f} +/- {5:6.3f} | {6}dlogz: {7:6.3f} > {8:6.3f}   | mean(time):  {9:7.5f} | time: {10} \n"
+                    .format(nit, nc, ncall, eff,
+                         logz, logzerr, lkstr, delta_logz, delta_logz_final,np.mean(itertimes),datetime.now()))
+          except:
+               print(nit, nc, ncall, eff, logz, logzerr)
+          sys.stdout.flush()
+
+     def _initpool(self,samplerdict):
+          """Set up the optional parallel pool for the likelihood calls, 
+          either a user supplied pool (e.g., from schwimmbad) or a 
+          multiprocessing pool with nproc workers. 
+
+          For a multiprocessing pool the likelihood and prior objects are 
+          handed to each worker once when it starts, rather than pickled 
+          along with every call. Set MISToutputmmap so that the MIST 
+          outputs are mapped from disk instead of copied into spawned 
+          workers. Note that 'rslice'/'rwalk' sampling makes 
+          better use of the pool than 'unif' after the first bound update.
+
+          Returns the kwargs for the dynesty sampler. A pool created here 
+          is kept in self._ownpool and shut down by run_dynesty.
+          """
+          pool = samplerdict.get('pool',None)
+          queue_size = samplerdict.get('queue_size',None)
+          nproc = samplerdict.get('nproc',1)
+
+          samplerkw = ({
+               'loglikelihood':lnprobfn,
+               'prior_transform':self.priorobj.priortrans,
+               'logl_args':[self.likeobj,self.priorobj],
+               'pool':pool,
+               'queue_size':queue_size,
+               })
+
+          if (pool is None) and (nproc > 1):
+               self._ownpool = Pool(nproc,
+                    initializer=_initworker,
+                    initargs=(self.likeobj,self.priorobj))
+               samplerkw['loglikelihood'] = lnprobfn_worker
+               samplerkw['prior_transform'] = priortrans_worker
+               samplerkw['logl_args'] = None
+               samplerkw['pool'] = self._ownpool
+
+          if (samplerkw['pool'] is not None) and (nproc > 1):
+               samplerkw['queue_size'] = queue_size or nproc
+
+          if self.verbose and (samplerkw['pool'] is not None):
+               print('... Running likelihood in parallel pool w/ queue_size = {0}'.format(
+                    samplerkw['queue_size']))
+
+          return samplerkw
+
      def __call__(self,indicts):
           '''
           call instance so that run_dynesty can be called with multiprocessing
@@ -268,12 +368,27 @@ class FitMS(object):
           
           runsamplertype = samplerdict.get('samplertype','Static')
 
-          if runsamplertype == 'Static':
-               # run sampler and return sampler object
-               return self._runsampler(samplerdict)
-          elif runsamplertype == 'Dynamic':
-               return self._rundysampler(samplerdict)
-          elif runsamplertype == 'Test':
+          self._rowbuf = []
+          self.outff = None
+          self._ownpool = None
+          try:
+               if runsamplertype == 'Static':
+                    # run sampler and return sampler object
+                    return self._runsampler(samplerdict)
+               elif runsamplertype == 'Dynamic':
+                    return self._rundysampler(samplerdict)
+          finally:
+               # write out any buffered rows if sampling was interrupted
+               if (self.outff is not None) and (not self.outff.closed):
+                    self._flushoutput()
+               # shut down the fitter's own pool, also if sampling failed, 
+               # so no workers are left behind
+               if self._ownpool is not None:
+                    self._ownpool.terminate()
+                    self._ownpool.join()
+                    self._ownpool = None
+
+          if runsamplertype == 'Test':
                return self
           else:
                print('Did not understand sampler type, return nothing')
@@ -289,6 +404,8 @@ class FitMS(object):
           samplemethod = samplerdict.get('samplemethod','unif')
           delta_logz_final = samplerdict.get('delta_logz_final',0.01)
           flushnum = samplerdict.get('flushnum',10)
+          # minimum wall time (s) between verbose status lines
+          printtime = samplerdict.get('printtime',2.0)
           numslice = samplerdict.get('slices',5)
           numwalks = samplerdict.get('walks',25)
           reflective_list = samplerdict.get('reflective',[])
@@ -330,12 +447,12 @@ class FitMS(object):
                print('Max Iter: {0} / Max Call: {1}'.format(maxiter,maxcall))
           sys.stdout.flush()
 
+          # set up the optional parallel pool
+          samplerkw = self._initpool(samplerdict)
+
           # initialize sampler object
           dy_sampler = dynesty.NestedSampler(
-               lnprobfn,
-               self.priorobj.priortrans,
-               self.ndim,
-               logl_args=[self.likeobj,self.priorobj],
+               ndim=self.ndim,
                nlive=npoints,
                bound=samplertype,
                sample=samplemethod,
@@ -348,17 +465,19 @@ class FitMS(object):
                # first_update={'min_eff':5.0,'min_ncall':1000},
                # vol_dec=4.0,
                # vol_check=0.1,
+               **samplerkw
                )
           sys.stdout.flush()
 
           ncall = 0
           nit = 0
 
-          iter_starttime = datetime.now()
+          iter_starttime = time.monotonic()
+          lastprint = iter_starttime - printtime
           deltaitertime_arr = []
 
           # start sampling
-          print('Start Sampling @ {}'.format(iter_starttime))
+          print('Start Sampling @ {}'.format(datetime.now()))
           for it, results in enumerate(dy_sampler.sample(
                dlogz=delta_logz_final,
                maxiter=maxiter,
@@ -367,19 +486,19 @@ class FitMS(object):
                (worst, ustar, vstar, loglstar, logvol, logwt, logz, logzvar,
                     h, nc, worst_it, propidx, propiter, eff, delta_logz) = results             
 
+               # recompute the derived parameters for the dead point, the 
+               # last likelihood call was for a different point (or was 
+               # made in a pool worker)
+               self.likeobj.lnlikefn(vstar)
+
                if it == 0:
                     # initialize the output file
                     parnames = self.likeobj.parsdict.keys()
                     self._initoutput(parnames)
 
-               self.outff.write('{0} '.format(it))
-               # self.outff.write(' '.join([str(q) for q in vstar]))
                try:
-                    self.outff.write(
-                         ' '.join(
-                              [str(self.likeobj.parsdict[q]) 
-                              if (isinstance(self.likeobj.parsdict[q],float) or isinstance(self.likeobj.parsdict[q],int)) 
-                              else 'nan' for q in parnames]))
+                    self._writerow(it,
+                         (loglstar,logvol,logwt,h,nc,logz,delta_logz))
                except:
                     print('Sampling broke')
                     print('worst:',worst)
@@ -400,46 +519,29 @@ class FitMS(object):
                     print(self.likeobj.parsdict)
                     raise
 
-               self.outff.write(' {0} {1} {2} {3} {4} {5} {6} '.format(
-                    loglstar,logvol,logwt,h,nc,logz,delta_logz))
-               self.outff.write('\n')
-
                ncall += nc
                nit = it
 
-               deltaitertime_arr.append((datetime.now()-iter_starttime).total_seconds()/float(nc))
-               iter_starttime = datetime.now()
+               itertime = time.monotonic()
+               deltaitertime_arr.append((itertime-iter_starttime)/float(nc))
+               iter_starttime = itertime
 
                if ((it%flushnum) == 0) or (it == maxiter):
-                    self.outff.flush()
-
-                    if self.verbose:
-                         # format/output results
-                         if logz < -1e6:
-                              logz = -np.inf
-                         if delta_logz > 1e8:
-                              delta_logz = np.inf
-                         if logzvar > 0.:
-                              logzerr = np.sqrt(logzvar)
-                         else:
-                              logzerr = np.nan
-                         if logzerr > 1e8:
-                              logzerr = np.inf
-
-                         if loglstar < -1e6:
-                              loglstar = -np.inf
-                         try:
-                              sys.stdout.write("\riter: {0:d} | nc: {1:d} | ncall: {2:d} | eff(%): {3:6.3f} | "
-                                   "logz: {4:6.3f} +/- {5:6.3f} | loglk: {6:6.3f} | dlogz: {7:6.3f} > {8:6.3f}   | mean(time):  {9:7.5f} | time: {10} \n"
-                                   .format(nit, nc, ncall, eff, 
-                                        logz, logzerr, loglstar, delta_logz, delta_logz_final,np.mean(deltaitertime_arr),datetime.now()))
-                         except:
-                              print(nit, nc, ncall, eff, logz, logzerr)
-                         sys.stdout.flush()
-                         deltaitertime_arr = []
+                    self._flushoutput()
+
+               if self.verbose and ((itertime-lastprint) > printtime):
+                    lastprint = itertime
+                    self._printstatus(nit,nc,ncall,eff,logz,logzvar,delta_logz,
+                         delta_logz_final,deltaitertime_arr,loglstar=loglstar)
+                    deltaitertime_arr = []
                if (it == maxiter):
                     break
 
+          # status of the last iteration, if not already printed
+          if self.verbose and (len(deltaitertime_arr) > 0):
+               self._printstatus(nit,nc,ncall,eff,logz,logzvar,delta_logz,
+                    delta_logz_final,deltaitertime_arr,loglstar=loglstar)
+
           print('Add live points to output file')
 
           # add live points to sampler object
@@ -448,20 +550,9 @@ class FitMS(object):
                (worst, ustar, vstar, loglstar, logvol, logwt, logz, logzvar,
                h, nc, worst_it, boundidx, bounditer, eff, delta_logz) = results
 
-               self.outff.write('{0} '.format(nit+it2))
-
-               # self.outff.write(' '.join([str(q) for q in vstar]))
                self.likeobj.lnlikefn(vstar)
-               self.outff.write(
-                    ' '.join(
-                         [str(self.likeobj.parsdict[q]) 
-                         if (isinstance(self.likeobj.parsdict[q],float) or isinstance(self.likeobj.parsdict[q],int)) 
-                         else 'nan' for q in parnames]))
-
-               # self.outff.write(' '.join([str(self.likeobj.parsdict[q]) for q in parnames]))
-               self.outff.write(' {0} {1} {2} {3} {4} {5} {6} '.format(
-                    loglstar,logvol,logwt,h,nc,logz,delta_logz))
-               self.outff.write('\n')
+               self._writerow(nit+it2,
+                    (loglstar,logvol,logwt,h,nc,logz,delta_logz))
 
                ncall += nc
 
@@ -484,6 +575,7 @@ class FitMS(object):
 
                     sys.stdout.flush()
 
+          self._flushoutput()
           self.outff.close()
           sys.stdout.write('\n')
 
@@ -502,6 +594,8 @@ class FitMS(object):
           samplemethod = samplerdict.get('samplemethod','unif')
           delta_logz_final = samplerdict.get('delta_logz_final',0.01)
           flushnum = samplerdict.get('flushnum',10)
+          # minimum wall time (s) between verbose status lines
+          printtime = samplerdict.get('printtime',2.0)
           numslice = samplerdict.get('slices',5)
           numwalks = samplerdict.get('walks',25)
 
@@ -521,18 +615,19 @@ class FitMS(object):
           sys.stdout.flush()
 
 
+          # set up the optional parallel pool
+          samplerkw = self._initpool(samplerdict)
+
           # initialize sampler object
           dy_sampler = dynesty.DynamicNestedSampler(
-               lnprobfn,
-               self.priorobj.priortrans,
-               self.ndim,
-               logl_args=[self.likeobj,self.priorobj],
+               ndim=self.ndim,
                bound=samplertype,
                sample=samplemethod,
                update_interval=update_interval,
                bootstrap=bootstrap,
                walks=numwalks,
                slices=numslice,
+               **samplerkw
                )
 
           sys.stdout.flush()
@@ -540,7 +635,8 @@ class FitMS(object):
           ncall = 0
           nit = 0
 
-          iter_starttime = datetime.now()
+          iter_starttime = time.monotonic()
+          lastprint = iter_starttime - printtime
           deltaitertime_arr = []
           for it, results in enumerate(dy_sampler.sample_initial(
                nlive=npoints,
@@ -553,57 +649,48 @@ class FitMS(object):
                ncall += nc
                nit = it
 
+               # recompute the derived parameters for the dead point, the 
+               # last likelihood call was for a different point (or was 
+               # made in a pool worker)
+               self.likeobj.lnlikefn(vstar)
+
                if it == 0:
                     # initialize the output file
                     parnames = self.likeobj.parsdict.keys()
                     self._initoutput(parnames)
 
-               self.outff.write('{0} '.format(it))
-               self.outff.write(
-                    ' '.join(
-                         [str(self.likeobj.parsdict[q]) 
-                         if (isinstance(self.likeobj.parsdict[q],float) or isinstance(self.likeobj.parsdict[q],int))
-                         else 'nan' 
-                         for q in parnames]))
-               self.outff.write(' {0} {1} {2} {3} {4} {5} {6} '.format(
-                    loglstar,logvol,logwt,h,nc,logz,delta_logz))
-               self.outff.write('\n')
+               self._writerow(it,
+                    (loglstar,logvol,logwt,h,nc,logz,delta_logz))
 
-               deltaitertime_arr.append((datetime.now()-iter_starttime).total_seconds()/float(nc))
-               iter_starttime = datetime.now()
+               itertime = time.monotonic()
+               deltaitertime_arr.append((itertime-iter_starttime)/float(nc))
+               iter_starttime = itertime
 
                if ((it%flushnum) == 0) or (it == maxiter):
-                    self.outff.flush()
-
-                    if self.verbose:
-                         # format/output results
-                         if logz < -1e6:
-                              logz = -np.inf
-                         if delta_logz > 1e6:
-                              delta_logz = np.inf
-                         if logzvar >= 0.:
-                              logzerr = np.sqrt(logzvar)
-                         else:
-                              logzerr = np.nan
-                         if logzerr > 1e6:
-                              logzerr = np.inf
-                              
-                         sys.stdout.write("\riter: {0:d} | nc: {1:d} | ncall: {2:d} | eff(%): {3:6.3f} | "
-                              "logz: {4:6.3f} +/- {5:6.3f} | dlogz: {6:6.3f} > {7:6.3f}   | mean(time):  {8:7.5f} | time: {9} \n"
-                              .format(nit, nc, ncall, eff, 
-                                   logz, logzerr, delta_logz, delta_logz_final,np.mean(deltaitertime_arr),datetime.now()))
-                         sys.stdout.flush()
-                         deltaitertime_arr = []
+                    self._flushoutput()
+
+               if self.verbose and ((itertime-lastprint) > printtime):
+                    lastprint = itertime
+                    self._printstatus(nit,nc,ncall,eff,logz,logzvar,delta_logz,
+                         delta_logz_final,deltaitertime_arr)
+                    deltaitertime_arr = []
                if (it == maxiter):
                     break
 
+          # status of the last iteration, if not already printed
+          if self.verbose and (len(deltaitertime_arr) > 0):
+               self._printstatus(nit,nc,ncall,eff,logz,logzvar,delta_logz,
+                    delta_logz_final,deltaitertime_arr)
+
+          self._flushoutput()
           sys.stdout.write('\n Finished Initial Static Run {0}\n'.format(datetime.now()-starttime))
           sys.stdout.flush()
 
           ncall = 0
           nit = 0
 
-          iter_starttime = datetime.now()
+          iter_starttime = time.monotonic()
+          lastprint = iter_starttime - printtime
           deltaitertime_arr = []
           for n in range(dy_sampler.batch,maxiter):
                res = dy_sampler.results
@@ -623,46 +710,24 @@ class FitMS(object):
                          (worst, ustar, vstar, loglstar, nc, worst_it, propidx, propiter, eff) = results2
 
                          ncall += nc
-                         self.outff.write('{0} '.format(nit+it2))
 
-                         # self.outff.write(' '.join([str(q) for q in vstar]))
                          self.likeobj.lnlikefn(vstar)
-                         self.outff.write(
-                              ' '.join(
-                                   [str(self.likeobj.parsdict[q]) 
-                                   if (isinstance(self.likeobj.parsdict[q],float) or isinstance(self.likeobj.parsdict[q],int))
-                                   else 'nan' 
-                                   for q in parnames]))
-                         self.outff.write(' {0} {1} {2} {3} {4} {5} {6} '.format(
-                              loglstar,logvol,logwt,h,nc,logz,delta_logz))
-                         self.outff.write('\n')
-
-
-                         deltaitertime_arr.append((datetime.now()-iter_starttime).total_seconds()/float(nc))
-                         iter_starttime = datetime.now()
-
-                         if ((it%flushnum) == 0) or (it == maxiter):
-                              self.outff.flush()
-
-                              if self.verbose:
-                                   # format/output results
-                                   if logz < -1e6:
-                                        logz = -np.inf
-                                   if delta_logz > 1e6:
-                                        delta_logz = np.inf
-                                   if logzvar >= 0.:
-                                        logzerr = np.sqrt(logzvar)
-                                   else:
-                                        logzerr = np.nan
-                                   if logzerr > 1e6:
-                                        logzerr = np.inf
-                                        
-                                   sys.stdout.write("\riter: {0:d} | nc: {1:d} | ncall: {2:d} | eff(%): {3:6.3f} | "
-                                        "logz: {4:6.3f} +/- {5:6.3f} | dlogz: {6:6.3f} > {7:6.3f}   | mean(time):  {8:7.5f} | time: {9} \n"
-                                        .format(nit, nc, ncall, eff, 
-                                             logz, logzerr, delta_logz, delta_logz_final,np.mean(deltaitertime_arr),datetime.now()))
-                                   sys.stdout.flush()
-                                   deltaitertime_arr = []
+                         self._writerow(nit+it2,
+                              (loglstar,logvol,logwt,h,nc,logz,delta_logz))
+
+
+                         itertime = time.monotonic()
+                         deltaitertime_arr.append((itertime-iter_starttime)/float(nc))
+                         iter_starttime = itertime
+
+                         if ((it2%flushnum) == 0) or (it2 == maxiter):
+                              self._flushoutput()
+
+                         if self.verbose and ((itertime-lastprint) > printtime):
+                              lastprint = itertime
+                              self._printstatus(nit,nc,ncall,eff,logz,logzvar,delta_logz,
+                                   delta_logz_final,deltaitertime_arr)
+                              deltaitertime_arr = []
                          if (it == maxiter):
                               break
                     sys.stdout.flush()
@@ -670,6 +735,13 @@ class FitMS(object):
                else:
                     break
 
+          # status of the last iteration, if not already printed
+          if self.verbose and (len(deltaitertime_arr) > 0):
+               self._printstatus(nit,nc,ncall,eff,logz,logzvar,delta_logz,
+                    delta_logz_final,deltaitertime_arr)
+
+          self._flushoutput()
+
           sys.stdout.write('\n Finished Full Dynamic Run {0}\n'.format(datetime.now()-starttime))
           sys.stdout.flush()
 
@@ -677,14 +749,29 @@ class FitMS(object):
 
 def lnprobfn(pars,likeobj,priorobj):
 
+     # scalar checks, also catch NaN from the likelihood or prior
      lnlike = likeobj.lnlikefn(pars)
      
-     if lnlike == -np.inf:
+     if not math.isfinite(lnlike):
           return -np.inf
 
      lnprior = priorobj.lnpriorfn(likeobj.parsdict)
 
-     if lnprior == -np.inf:
+     if not math.isfinite(lnprior):
           return -np.inf
 
      return lnprior + lnlike  
+
+# likelihood and prior objects for the multiprocessing pool workers, 
+# set once per worker by _initworker
+_workerobjs = {}
+
+def _initworker(likeobj,priorobj):
+     _workerobjs['likeobj'] = likeobj
+     _workerobjs['priorobj'] = priorobj
+
+def lnprobfn_worker(pars):
+     return lnprobfn(pars,_workerobjs['likeobj'],_workerobjs['priorobj'])
+
+def priortrans_worker(upars):
+     return _workerobjs['priorobj'].priortrans(upars)
@@ -8,6 +8,11 @@ from scipy.optimize import minimize_scalar, minimize, brute, basinhopping, diffe
 
 from .smoothing import smoothspec
 
+# chi-square returned for parameters outside of the allowed ranges
+badchisq = np.nan_to_num(np.inf)
+# allowed ranges of the SED parameters in SEDopt
+sedparlimits = {'logg':(-1.0,5.5),'FeH':(-4.0,0.5),'aFe':(-0.2,0.6),'Av':(0.0,np.inf)}
+
 def polycalc(coef,inwave):
      # define obs wave on normalized scale
      x = inwave - inwave.min()
@@ -194,6 +199,13 @@ class SEDopt(object):
           self.tol = kwargs.get('tol',1E-15)
           self.maxiter = kwargs.get('maxiter',1E5)
 
+          # optimizer: 'NM' for a Nelder-Mead minimization starting at initpars, 
+          # or 'DE' for a differential evolution global search within bounds 
+          # with trial SEDs evaluated in parallel over nproc workers (-1 = all cores)
+          self.opttype = kwargs.get('opttype','NM')
+          self.bounds = kwargs.get('bounds',{})
+          self.nproc = kwargs.get('nproc',-1)
+
           # use lum and dist or logA
           if ('logL' in self.fixedpars) or ('logL' in self.init_p0):
                fitpars_i = ['Teff','logg','FeH','aFe','logL','Dist','Av']
@@ -208,6 +220,27 @@ class SEDopt(object):
                print('FIX PARS:',list(self.fixedpars.keys()))
                raise(IOError)
 
+          if (self.opttype == 'DE') and any([x not in self.bounds.keys() for x in self.fitpars]):
+               print('DE OPTIMIZER NEEDS BOUNDS FOR ALL FIT PARS')
+               print('FIT PARS:',self.fitpars)
+               print('BOUNDS:',self.bounds)
+               raise(IOError)
+
+          if self.opttype == 'DE':
+               # clip the bounds to the allowed ranges, badchisq values in the 
+               # population would overflow the DE convergence test
+               self.bounds = dict(self.bounds)
+               for x in self.fitpars:
+                    lo,hi = self.bounds[x]
+                    if x in sedparlimits.keys():
+                         lo = max(lo,sedparlimits[x][0])
+                         hi = min(hi,sedparlimits[x][1])
+                    if lo >= hi:
+                         print('DE BOUNDS FOR {0} OUTSIDE OF ALLOWED RANGE:'.format(x),
+                              self.bounds[x],sedparlimits.get(x))
+                         raise(IOError)
+                    self.bounds[x] = (lo,hi)
+
           self.fsed = FastPayneSEDPredict(
                usebands=self.filterarray,
                nnpath=photANNpath)
@@ -216,15 +249,26 @@ class SEDopt(object):
 
      def __call__(self):
 
-          p0 = [self.init_p0[x] for x in self.fitpars]
+          if self.opttype == 'DE':
+               output = [differential_evolution(
+                    self.chisq_sed,
+                    [self.bounds[x] for x in self.fitpars],
+                    workers=self.nproc,
+                    updating='deferred',
+                    polish=True,
+                    tol=1E-4,
+                    disp=self.verbose,
+                    ).x]
+          else:
+               p0 = [self.init_p0[x] for x in self.fitpars]
 
-          output = [minimize(
-               self.chisq_sed,
-               p0,
-               method='Nelder-Mead',
-               tol=10E-15,
-               options={'maxiter':1E5,'disp':self.verbose}
-               ).x]
+               output = [minimize(
+                    self.chisq_sed,
+                    p0,
+                    method='Nelder-Mead',
+                    tol=10E-15,
+                    options={'maxiter':1E5,'disp':self.verbose}
+                    ).x]
 
           if self.returnsed:
                outfitpars = {}
@@ -285,17 +329,9 @@ class SEDopt(object):
                     'av':allparsdict['Av'],
                     })
 
-          if (photpars['logg'] < -1.0) or (photpars['logg'] > 5.5):
-               return np.nan_to_num(np.inf)
-
-          if (photpars['feh'] < -4.0) or (photpars['feh'] > 0.5):
-               return np.nan_to_num(np.inf)
-
-          if (photpars['afe'] < -0.2) or (photpars['afe'] > 0.6):
-               return np.nan_to_num(np.inf)
-
-          if (photpars['av'] < 0.0):
-               return np.nan_to_num(np.inf)
+          for x,(lo,hi) in sedparlimits.items():
+               if (allparsdict[x] < lo) or (allparsdict[x] > hi):
+                    return badchisq
 
           sed = self.fsed.sed(**photpars)
           sedmod = {ff_i:sed_i for sed_i,ff_i in zip(sed,self.filterarray)}
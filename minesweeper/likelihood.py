@@ -47,7 +47,8 @@ class likelihood(object):
 
           if fitpars[1]['EEP']:
                self.GMIST = GenMIST(MISTpath=self.fitargs['MISTpath'],
-                    ageweight=self.ageweight)
+                    ageweight=self.ageweight,
+                    outputmmap=self.fitargs.get('MISToutputmmap',None))
 
 
           # determine the number of dims